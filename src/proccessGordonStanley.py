@@ -90,20 +90,20 @@ class GordonStanleyDataProcessor():
     #helper fxn
     def tensorGordon(self, y_train, y_test, target_y_train, target_y_test, u_train, u_test, z_train, z_test, target_z_train, target_z_test):    
         #convert data into tensors
-        y_train_tensor = torch.from_numpy(y_train)
-        y_test_tensor = torch.from_numpy(y_test)
+        y_train_tensor = torch.from_numpy(y_train).float()
+        y_test_tensor = torch.from_numpy(y_test).float()
 
-        target_y_train_tensor = torch.from_numpy(target_y_train)
-        target_y_test_tensor = torch.from_numpy(target_y_test)
+        target_y_train_tensor = torch.from_numpy(target_y_train).float()
+        target_y_test_tensor = torch.from_numpy(target_y_test).float()
 
-        u_train_tensor = torch.from_numpy(u_train)
-        u_test_tensor = torch.from_numpy(u_test)
+        u_train_tensor = torch.from_numpy(u_train).float()
+        u_test_tensor = torch.from_numpy(u_test).float()
 
-        z_train_tensor = torch.from_numpy(z_train)
-        z_test_tensor = torch.from_numpy(z_test)
+        z_train_tensor = torch.from_numpy(z_train).float()
+        z_test_tensor = torch.from_numpy(z_test).float()
 
-        target_z_train_tensor = torch.from_numpy(target_z_train)
-        target_z_test_tensor = torch.from_numpy(target_z_test)
+        target_z_train_tensor = torch.from_numpy(target_z_train).float()
+        target_z_test_tensor = torch.from_numpy(target_z_test).float()
 
 
         return y_train_tensor, y_test_tensor, target_y_train_tensor, target_y_test_tensor, u_train_tensor, u_test_tensor, z_train_tensor, z_test_tensor, target_z_train_tensor, target_z_test_tensor
@@ -242,21 +242,21 @@ class GordonStanleyDataProcessor():
     #helper fxn
     def tensorNWB(self, y_train, y_test, target_y_train, target_y_test, u_train, u_test, z_train, z_test, target_z_train, target_z_test):    
         #convert data into tensors
-        y_train_tensor = torch.from_numpy(y_train).double()
-        y_test_tensor = torch.from_numpy(y_test).double()
+        y_train_tensor = torch.from_numpy(y_train).float()
+        y_test_tensor = torch.from_numpy(y_test).float()
 
-        target_y_train_tensor = torch.from_numpy(target_y_train).double()
-        target_y_test_tensor = torch.from_numpy(target_y_test).double()
+        target_y_train_tensor = torch.from_numpy(target_y_train).float()
+        target_y_test_tensor = torch.from_numpy(target_y_test).float()
 
-        u_train_tensor = torch.from_numpy(u_train).double()
-        u_test_tensor = torch.from_numpy(u_test).double()
+        u_train_tensor = torch.from_numpy(u_train).float()
+        u_test_tensor = torch.from_numpy(u_test).float()
 
         if (self.hasBehav):
-            z_train_tensor = torch.from_numpy(z_train).double()
-            z_test_tensor = torch.from_numpy(z_test).double()
+            z_train_tensor = torch.from_numpy(z_train).float()
+            z_test_tensor = torch.from_numpy(z_test).float()
 
-            target_z_train_tensor = torch.from_numpy(target_z_train).double()
-            target_z_test_tensor = torch.from_numpy(target_z_test).double()
+            target_z_train_tensor = torch.from_numpy(target_z_train).float()
+            target_z_test_tensor = torch.from_numpy(target_z_test).float()
             return y_train_tensor, y_test_tensor, target_y_train_tensor, target_y_test_tensor, u_train_tensor, u_test_tensor, z_train_tensor, z_test_tensor, target_z_train_tensor, target_z_test_tensor
 
         return y_train_tensor, y_test_tensor, target_y_train_tensor, target_y_test_tensor, u_train_tensor, u_test_tensor, None, None, None, None
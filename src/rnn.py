@@ -8,9 +8,9 @@ class CustomRNNCell(nn.Module):
     def __init__(self, x_size, y_size, u_size):
         super(CustomRNNCell, self).__init__()
         self.xNext_size = x_size
-        self.W_A = nn.Linear(x_size, self.xNext_size, dtype=torch.double)
-        self.W_K = nn.Linear(y_size, self.xNext_size, dtype=torch.double)
-        self.W_B = nn.Linear(u_size, self.xNext_size, dtype=torch.double)
+        self.W_A = nn.Linear(x_size, self.xNext_size)
+        self.W_K = nn.Linear(y_size, self.xNext_size)
+        self.W_B = nn.Linear(u_size, self.xNext_size)
 
     def forward(self, x_t, y_t, u_t):
         print(x_t.dtype)
@@ -24,15 +24,15 @@ class CustomRNN(nn.Module):
         super(CustomRNN, self).__init__()
         self.x_size = x_size
         self.rnn_cell = CustomRNNCell(x_size, y_size, u_size)
-        self.W_Cy = nn.Linear(x_size, yhat_size, dtype=torch.double)
-        self.W_Cz = nn.Linear(x_size, zhat_size, dtype=torch.double)
+        self.W_Cy = nn.Linear(x_size, yhat_size)
+        self.W_Cz = nn.Linear(x_size, zhat_size)
 
     def forward(self, y, u):
         # Assuming y and u are of shape (batch_size, seq_len, feature_size)
         batch_size, seq_len, _ = y.size()
 
         # Initialize the hidden state
-        x_t = torch.zeros(batch_size, self.x_size, dtype= torch.double).to(y.device)
+        x_t = torch.zeros(batch_size, self.x_size).to(y.device)
         
         # Iterate over the sequence
         y_hats = []
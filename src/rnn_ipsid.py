@@ -12,9 +12,9 @@ class Optim1Cell(nn.Module):
     def __init__(self, x_size, y_size, u_size):
         super(Optim1Cell, self).__init__()
         self.xNext_size = x_size
-        self.W_A = nn.Linear(x_size, self.xNext_size, dtype=torch.double)
-        self.W_K = nn.Linear(y_size, self.xNext_size, dtype=torch.double)
-        self.W_B = nn.Linear(u_size, self.xNext_size, dtype=torch.double)
+        self.W_A = nn.Linear(x_size, self.xNext_size)
+        self.W_K = nn.Linear(y_size, self.xNext_size)
+        self.W_B = nn.Linear(u_size, self.xNext_size)
 
     def forward(self, xBehav_t, y_t, u_t):
         xNext = self.W_A(xBehav_t) + self.W_K(y_t) + self.W_B(u_t)
@@ -26,23 +26,27 @@ class Optim1(nn.Module):
         self.xBehav_size = xBehav_size
         self.yhat_size = yhat_size
         self.rnn_cell = Optim1Cell(xBehav_size, y_size, u_size)
-        self.W_Cz1 = nn.Linear(xBehav_size, zhat_size, dtype=torch.double)
+        self.W_Cz1 = nn.Linear(xBehav_size, zhat_size)
 
     def forward(self, y, u):
         # Assuming y and u are of shape (batch_size, seq_len, feature_size)
         batch_size, seq_len, _ = y.size()
 
         # Initialize behavioral state with zeros
-        xBehav_t = torch.zeros(batch_size, self.xBehav_size, dtype= torch.double).to(y.device)
+        xBehav_t = torch.zeros(batch_size, self.xBehav_size).to(y.device)
         
+        # Time-major (seq_len, batch_size, feature_size), so every per-step slice is contiguous
+        y_tb = y.transpose(0, 1).contiguous().unbind(0)
+        u_tb = u.transpose(0, 1).contiguous().unbind(0)
+
         # Iterate over the sequence
         behavStates = [] #xBehav
         z_hats1 = [] #Cz1(xBehav)
 
         for t in range(seq_len):
             behavStates.append(xBehav_t)
-            y_t = y[:,t,:]
-            u_t = u[:,t, :]
+            y_t = y_tb[t]
+            u_t = u_tb[t]
             x_next = self.rnn_cell(xBehav_t, y_t, u_t) #forward pass into custom rnn cell
             z_pred = self.W_Cz1(xBehav_t) #forward pass from x_t+1 (linear combination of x_t+1 -> z_t+1) included in backprop
             z_hats1.append(z_pred)
@@ -56,7 +60,7 @@ class Optim1(nn.Module):
 class Optim2(torch.nn.Module):
     def __init__(self, xBehav_size, yhat_size):
         super(Optim2, self).__init__()
-        self.W_Cy1 = nn.Linear(xBehav_size, yhat_size, dtype=torch.double)
+        self.W_Cy1 = nn.Linear(xBehav_size, yhat_size)
 
     def forward(self, xBehav_t):
         # Assuming xBehav_t has shape (batch_size, seq_len, feature_size)
@@ -80,40 +84,49 @@ class Optim2(torch.nn.Module):
 class Optim3Cell(nn.Module):
     def __init__(self, xBehavioral_size, xNeural_size, y_size, u_size):
         super(Optim3Cell, self).__init__()
-        self.W_A = nn.Linear(xNeural_size, xNeural_size, dtype=torch.double)
-        self.W_K = nn.Linear(y_size + xBehavioral_size, xNeural_size, dtype=torch.double)
-        self.W_B = nn.Linear(u_size, xNeural_size, dtype=torch.double)
+        self.W_A = nn.Linear(xNeural_size, xNeural_size)
+        self.W_K = nn.Linear(y_size + xBehavioral_size, xNeural_size)
+        self.W_B = nn.Linear(u_size, xNeural_size)
 
     def forward(self, xNeural_t, yAndxBehav_t, u_t):
         xNext = self.W_A(xNeural_t) + self.W_K(yAndxBehav_t) + self.W_B(u_t)
         return xNext
 
 class Optim3(nn.Module):
-    def __init__(self, xBehavioral_size, xNeural_size, y_size, u_size, yhat_size, zhat_size):
+    def __init__(self, xBehavioral_size, xNeural_size, y_size, u_size, yhat_size, zhat_size, detach_behav_states = True):
         super(Optim3, self).__init__()
         self.xNeural_size = xNeural_size
+        self.detach_behav_states = detach_behav_states
         self.zhat_size = zhat_size
         self.rnn_cell = Optim3Cell(xBehavioral_size, xNeural_size, y_size, u_size)
-        self.W_Cy2 = nn.Linear(xNeural_size, yhat_size, dtype=torch.double)
+        self.W_Cy2 = nn.Linear(xNeural_size, yhat_size)
 
     def forward(self, behavStates, y, u):
         # Assuming y and u are of shape (batch_size, seq_len, feature_size)
         batch_size, seq_len, _ = y.size()
 
+        # Stage 1 is already trained, so backprop stops at behavStates (detach_behav_states=False trains both stages jointly)
+        if self.detach_behav_states:
+            behavStates = behavStates.detach()
+
         # Initialize neural state with zeros
-        xNeural_t = torch.zeros(batch_size, self.xNeural_size, dtype = torch.double).to(y.device)
+        xNeural_t = torch.zeros(batch_size, self.xNeural_size).to(y.device)
 
         #horizontally combine neural data (y) and behavioral latent states (behavStates)
         yAndxBehav = torch.cat((y, behavStates), dim = 2)
 
+        # Time-major (seq_len, batch_size, feature_size), so every per-step slice is contiguous
+        yAndxBehav_tb = yAndxBehav.transpose(0, 1).contiguous().unbind(0)
+        u_tb = u.transpose(0, 1).contiguous().unbind(0)
+
         # Iterate over the sequence
         y_hats2 = [] #Cy2(xNeural)
         xNeural_states = [] 
 
         for t in range(seq_len):
             xNeural_states.append(xNeural_t)
-            yAndxBehav_t = yAndxBehav[:,t,:]
-            u_t = u[:,t, :]
+            yAndxBehav_t = yAndxBehav_tb[t]
+            u_t = u_tb[t]
             x_next = self.rnn_cell(xNeural_t, yAndxBehav_t, u_t) #forward pass into custom rnn cell
             y_pred = self.W_Cy2(xNeural_t) #forward pass from x_t+1 (linear combination of x_t+1 -> y_t+1) included in backprop
             y_hats2.append(y_pred)
@@ -128,7 +141,7 @@ class Optim3(nn.Module):
 class Optim4(torch.nn.Module):
     def __init__(self, xNeural_size, zhat_size):
         super(Optim4, self).__init__()
-        self.W_Cz2 = nn.Linear(xNeural_size, zhat_size, dtype=torch.double)
+        self.W_Cz2 = nn.Linear(xNeural_size, zhat_size)
 
     def forward(self, xNeural_t):
          # Assuming xBehav_t has shape (batch_size, seq_len, feature_size)
@@ -2,6 +2,124 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+from torch.autograd.function import once_differentiable
+from torch.utils.checkpoint import checkpoint
+
+###################################################################################################################################################################
+
+#helper fxn - time loop of the linear recurrence x_t+1 = A*x_t + precomp_t, shared by both stages (forward of LinearRecurrence)
+@torch.jit.script
+def linear_recurrence(precomp: torch.Tensor, x0: torch.Tensor, W_A_weight: torch.Tensor) -> torch.Tensor:
+    # precomp is (batch_size, seq_len, x_size), x0 is (batch_size, x_size)
+    seq_len = precomp.size(1)
+    # transposed once to time-major (seq_len, batch_size, x_size) so every per-step slice is a contiguous (batch_size, x_size) block;
+    # unbind/stack (instead of precomp[:, t] reads and states[:, t] = ... writes) keep backward linear in seq_len,
+    # since every indexed read or in-place slice write adds a full (batch_size, seq_len, x_size) gradient buffer per step
+    precomp_tb = precomp.transpose(0, 1).contiguous().unbind(0)
+    W_A_T = W_A_weight.t() #transposed once, addmm below fuses the matmul with the add of precomp_t
+    # states[:, t] is x_t (the state before the update at t), so the state after the last step is never needed
+    states = [x0]
+    x_t = x0
+    for t in range(seq_len - 1):
+        x_t = torch.addmm(precomp_tb[t], x_t, W_A_T)
+        states.append(x_t)
+    return torch.stack(states, dim = 1)
+
+#helper fxn - hand-derived backward of linear_recurrence, the adjoint is the same recurrence with A^T run backwards in time
+@torch.jit.script
+def linear_recurrence_backward(grad_states: torch.Tensor, states: torch.Tensor, W_A_weight: torch.Tensor):
+    # g_t = dL/dx_t collects the direct gradient of states[:, t] plus g_t+1 * A, since x_t+1 = x_t*A^T + precomp_t
+    seq_len = states.size(1)
+    grad_tb = grad_states.transpose(0, 1).contiguous()
+    g = torch.empty_like(grad_tb) #time-major (seq_len, batch_size, x_size), no autograd graph here so in-place writes are cheap
+    g_t = grad_tb[seq_len - 1]
+    g[seq_len - 1] = g_t
+    for t in range(seq_len - 2, -1, -1):
+        g_t = torch.addmm(grad_tb[t], g_t, W_A_weight)
+        g[t] = g_t
+    g = g.transpose(0, 1)
+    # precomp_t only reaches x_t+1, the last precomp is never used
+    grad_precomp = torch.cat((g[:, 1:, :], torch.zeros_like(g[:, :1, :])), dim = 1)
+    grad_x0 = g[:, 0, :]
+    grad_W_A = g[:, 1:, :].reshape(-1, g.size(2)).t() @ states[:, :-1, :].reshape(-1, states.size(2)) #sum_t g_t+1^T * x_t
+    return grad_precomp, grad_x0, grad_W_A
+
+#helper class - linear_recurrence with its backward done as one reverse scan instead of seq_len autograd nodes
+class LinearRecurrence(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, precomp, x0, W_A_weight):
+        states = linear_recurrence(precomp, x0, W_A_weight)
+        ctx.save_for_backward(states, W_A_weight) #the states are the output anyway, so nothing else is kept for backward
+        return states
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_states):
+        states, W_A_weight = ctx.saved_tensors
+        return linear_recurrence_backward(grad_states.contiguous(), states, W_A_weight)
+
+#helper fxn - same recurrence as linear_recurrence, computed with a parallel (Hillis-Steele) scan over time
+def linear_recurrence_scan(precomp, x0, W_A_weight):
+    # x_t+1 = x_t*A^T + precomp_t is affine with a constant A, so after log2(seq_len) doubling rounds
+    # h_t = sum_{k<=t} precomp'_k * (A^T)^(t-k), where x0 is folded into precomp'_0
+    batch_size, seq_len, x_size = precomp.size()
+    M = W_A_weight.t()
+    h = torch.cat((precomp[:, :1, :] + x0.unsqueeze(1) @ M, precomp[:, 1:, :]), dim = 1) #h_t = x_t+1
+    offset = 1
+    while offset < seq_len:
+        h = torch.cat((h[:, :offset, :], h[:, offset:, :] + h[:, :-offset, :] @ M), dim = 1)
+        M = M @ M #(A^T)^(2*offset) for the next round
+        offset *= 2
+    # shift by one so states[:, t] is x_t, as in linear_recurrence
+    return torch.cat((x0.unsqueeze(1), h[:, :-1, :]), dim = 1)
+
+#helper fxn - runs the recurrence for Optim1/Optim3, the parallel scan optionally checkpointed in chunks along time
+def run_recurrence(precomp, x0, W_A_weight, parallel_scan = False, checkpoint_chunks = 0):
+    if not parallel_scan:
+        #LinearRecurrence only saves its own output for backward, so there is nothing for checkpointing to free
+        return LinearRecurrence.apply(precomp, x0, W_A_weight)
+    if checkpoint_chunks <= 1 or not torch.is_grad_enabled():
+        return linear_recurrence_scan(precomp, x0, W_A_weight)
+
+    # the scan keeps every doubling round for backward, with chunks only the chunk boundaries are kept
+    # and each chunk is re-run during backward to rebuild its graph
+    seq_len = precomp.size(1)
+    chunk_len = -(-seq_len // checkpoint_chunks)
+    states = []
+    x_t = x0
+    for start in range(0, seq_len, chunk_len):
+        precomp_chunk = precomp[:, start:start + chunk_len, :]
+        states_chunk = checkpoint(linear_recurrence_scan, precomp_chunk, x_t, W_A_weight, use_reentrant=False)
+        states.append(states_chunk)
+        x_t = torch.addmm(precomp_chunk[:, -1, :], states_chunk[:, -1, :], W_A_weight.t()) #first state of the next chunk
+    return torch.cat(states, dim = 1)
+
+#helper fxn - scripted readout Linear -> ReLU -> Linear -> Sigmoid so the pointwise ops fuse with the bias adds
+@torch.jit.script
+def mlp_readout(x: torch.Tensor, lin_weight: torch.Tensor, lin_bias: torch.Tensor, lin2_weight: torch.Tensor, lin2_bias: torch.Tensor, logits: bool = False) -> torch.Tensor:
+    # x is (batch_size, seq_len, feature_size), every time step goes through the same weights
+    out = F.linear(torch.relu(F.linear(x, lin_weight, lin_bias)), lin2_weight, lin2_bias)
+    if logits:
+        return out
+    return torch.sigmoid(out)
+
+#helper class - Linear -> ReLU -> Linear -> Sigmoid readout, the common structure of Cz1, Cy1, Cy2 and Cz2
+class MLP2(nn.Module):
+    def __init__(self, in_size, hidden_size, out_size, logits = False):
+        super(MLP2, self).__init__()
+        self.lin = nn.Linear(in_size, hidden_size)
+        self.lin2 = nn.Linear(hidden_size, out_size)
+        self.logits = logits #True leaves out the sigmoid, for a loss that takes logits (F.binary_cross_entropy_with_logits)
+    def forward(self, x):
+        # Assuming x has shape (batch_size, seq_len, feature_size)
+        # readout has no recurrence, so every time step is applied at once
+        return mlp_readout(x, self.lin.weight, self.lin.bias, self.lin2.weight, self.lin2.bias, self.logits)
+
+    @torch.no_grad()
+    def predict(self, x):
+        #probabilities for inference, with logits the sigmoid is applied once outside of the backward graph
+        out = self(x)
+        return torch.sigmoid(out) if self.logits else out
 
 ###################################################################################################################################################################
 
@@ -12,86 +130,60 @@ class Optim1Cell(nn.Module):
     def __init__(self, x_size, y_size, u_size):
         super(Optim1Cell, self).__init__()
         self.xNext_size = x_size
-        self.W_A = nn.Linear(x_size, self.xNext_size, dtype= torch.double)
-        self.W_K = nn.Linear(y_size, self.xNext_size, dtype= torch.double)
-        self.W_B = nn.Linear(u_size, self.xNext_size, dtype= torch.double)
+        self.W_A = nn.Linear(x_size, self.xNext_size, bias=False)
+        self.W_KB = nn.Linear(y_size + u_size, self.xNext_size) #[K B] fused into one weight, carries the only bias of the update
+
+    def premul(self, y, u):
+        #input-driven terms do not depend on the state, so compute them for every time step in one batched matmul
+        return self.W_KB(torch.cat((y, u), dim = 2))
 
-    def forward(self, xBehav_t, y_t, u_t):
-        xNext = self.W_A(xBehav_t) + self.W_K(y_t) + self.W_B(u_t)
-        return xNext
+    def forward(self, xBehav_0, precomp, parallel_scan = False, checkpoint_chunks = 0):
+        #x_t+1 = A*x_t + precomp_t over the whole sequence, returns x_t for every time step
+        return run_recurrence(precomp, xBehav_0, self.W_A.weight, parallel_scan, checkpoint_chunks)
 
 #helper class
-class NonlinearOptim1CellZ(nn.Module):
-    def __init__(self, xBehav_size, zhat_size):
-        super(NonlinearOptim1CellZ, self).__init__()
-        self.Cz1_lin = nn.Linear(xBehav_size, xBehav_size, dtype=torch.double)
-        self.Cz1_relu = nn.ReLU()
-        self.Cz1_lin2 = nn.Linear(xBehav_size, zhat_size, dtype=torch.double)
-        self.Cz1_sigmoid = nn.Sigmoid()
-    def forward(self, xBehav_t):
-        z_pred = self.Cz1_lin(xBehav_t)
-        z_pred = self.Cz1_relu(z_pred)
-        z_pred = self.Cz1_lin2(z_pred)
-        z_pred = self.Cz1_sigmoid(z_pred)
-        return z_pred
+class NonlinearOptim1CellZ(MLP2):
+    def __init__(self, xBehav_size, zhat_size, logits = False):
+        super(NonlinearOptim1CellZ, self).__init__(xBehav_size, xBehav_size, zhat_size, logits) #Cz1
     
 class Optim1(nn.Module):
-    def __init__(self, xBehav_size, y_size, u_size, yhat_size, zhat_size):
+    def __init__(self, xBehav_size, y_size, u_size, yhat_size, zhat_size, parallel_scan = False, checkpoint_chunks = 0, z_logits = False):
         super(Optim1, self).__init__()
         self.xBehav_size = xBehav_size
+        self.z_logits = z_logits #True returns Cz1 logits for a binary behavior fit with F.binary_cross_entropy_with_logits, predict() gives probabilities
+        self.parallel_scan = parallel_scan #O(log seq_len) depth scan instead of the sequential loop, useful for long sequences on GPU
+        self.checkpoint_chunks = checkpoint_chunks #>1 recomputes the parallel scan in this many chunks during backward to save activation memory
+        if checkpoint_chunks > 1 and not parallel_scan:
+            raise ValueError('checkpoint_chunks only applies to parallel_scan=True, the sequential loop keeps no activations to free')
         self.yhat_size = yhat_size
         self.rnn_cell = Optim1Cell(xBehav_size, y_size, u_size)
-        self.nonlinear_cellZ = NonlinearOptim1CellZ(xBehav_size, zhat_size)
+        self.nonlinear_cellZ = NonlinearOptim1CellZ(xBehav_size, zhat_size, z_logits)
+        self.register_buffer('x0', torch.zeros(1, xBehav_size), persistent=False) #initial behavioral state, follows the module on .to(device)
 
     def forward(self, y, u):
         # Assuming y and u are of shape (batch_size, seq_len, feature_size)
         batch_size, seq_len, _ = y.size()
 
         # Initialize behavioral state with zeros
-        xBehav_t = torch.zeros(batch_size, self.xBehav_size, dtype= torch.double).to(y.device)
+        xBehav_t = self.x0.expand(batch_size, -1)
         
-        # Iterate over the sequence
-        behavStates = [] #xBehav
-        z_hats1 = [] #Cz1(xBehav)
-
-        #initialize nonlinear regressor from behavioral state to neural (optimizer 2)
-        for t in range(seq_len):
-            behavStates.append(xBehav_t)
-            y_t = y[:,t,:]
-            u_t = u[:,t, :]
-            x_next = self.rnn_cell(xBehav_t, y_t, u_t) #linear forward pass into custom rnn cell
-            z_pred = self.nonlinear_cellZ(xBehav_t) #forward pass from x_t+1 (nonlinear combination of x_t+1 -> z_t+1) included in backprop
-            z_hats1.append(z_pred)
-            xBehav_t = x_next #x_t+1 becomes x_t for next time step (t) in for loop
-        
-        # Stack the outputs to get a tensor of shape (batch_size, seq_len, output_size)
-        behavStates = torch.stack(behavStates, dim=1) #xBehav
-        z_hats1 = torch.stack(z_hats1, dim=1) #Cz1(xBehav), used for the loss function and back prop of Stage 1
+        #K*y_t + B*u_t for all time steps, shape (batch_size, seq_len, xBehav_size)
+        precomp = self.rnn_cell.premul(y, u)
+
+        # Iterate over the sequence, the cell runs the whole recurrence in the scripted loop (or scan)
+        behavStates = self.rnn_cell(xBehav_t, precomp, self.parallel_scan, self.checkpoint_chunks) #xBehav, shape (batch_size, seq_len, xBehav_size)
+        z_hats1 = self.nonlinear_cellZ(behavStates) #Cz1(xBehav) over all time steps at once (logits with z_logits), used for the loss function and back prop of Stage 1
         return z_hats1, behavStates
 
-class Optim2(nn.Module):
+    @torch.no_grad()
+    def predict(self, y, u):
+        #sigmoid(Cz1(xBehav)) and the behavioral states for inference
+        z_hats1, behavStates = self(y, u)
+        return (torch.sigmoid(z_hats1) if self.z_logits else z_hats1), behavStates
+
+class Optim2(MLP2):
     def __init__(self, xBehav_size, yhat_size):
-        super(Optim2, self).__init__()
-        self.Cy1_lin = nn.Linear(xBehav_size, xBehav_size, dtype=torch.double)
-        self.Cy1_relu = nn.ReLU()
-        self.Cy1_lin2 = nn.Linear(xBehav_size, yhat_size, dtype=torch.double)
-        self.Cy1_sigmoid = nn.Sigmoid()
-    def forward(self, xBehav_t):
-        # Assuming xBehav_t has shape (batch_size, seq_len, feature_size)
-        _, seq_len, _ = xBehav_t.size()
-
-        y_hats1 = [] #Cy1(xBehav)
-
-        for t in range(seq_len):
-            x_t = xBehav_t[:,t,:]
-            y_pred = self.Cy1_lin(x_t)
-            y_pred = self.Cy1_relu(y_pred)
-            y_pred = self.Cy1_lin2(y_pred)
-            y_pred = self.Cy1_sigmoid(y_pred)
-            y_hats1.append(y_pred)
-        
-        y_hats1 = torch.stack(y_hats1, dim=1)
-        return y_hats1
+        super(Optim2, self).__init__(xBehav_size, xBehav_size, yhat_size) #Cy1
     
 ###################################################################################################################################################################
 
@@ -101,86 +193,60 @@ class Optim2(nn.Module):
 class Optim3Cell(nn.Module):
     def __init__(self, xBehavioral_size, xNeural_size, y_size, u_size):
         super(Optim3Cell, self).__init__()
-        self.W_A = nn.Linear(xNeural_size, xNeural_size, dtype=torch.double)
-        self.W_K = nn.Linear(y_size + xBehavioral_size, xNeural_size, dtype=torch.double)
-        self.W_B = nn.Linear(u_size, xNeural_size, dtype=torch.double)
+        self.W_A = nn.Linear(xNeural_size, xNeural_size, bias=False)
+        #K = [K_y K_xBehav] is split by input instead of acting on cat(y, behavStates), which saves that (batch_size, seq_len, y_size + xBehavioral_size) copy
+        self.W_Ky = nn.Linear(y_size, xNeural_size) #carries the only bias of the update
+        self.W_Kb = nn.Linear(xBehavioral_size, xNeural_size, bias=False)
+        self.W_B = nn.Linear(u_size, xNeural_size, bias=False)
+
+    def premul(self, y, behavStates, u):
+        #input-driven terms do not depend on the state, so compute them for every time step in one batched matmul
+        return self.W_Ky(y) + self.W_Kb(behavStates) + self.W_B(u)
 
-    def forward(self, xNeural_t, yAndxBehav_t, u_t):
-        xNext = self.W_A(xNeural_t) + self.W_K(yAndxBehav_t) + self.W_B(u_t)
-        return xNext
+    def forward(self, xNeural_0, precomp, parallel_scan = False, checkpoint_chunks = 0):
+        #x_t+1 = A*x_t + precomp_t over the whole sequence, returns x_t for every time step
+        return run_recurrence(precomp, xNeural_0, self.W_A.weight, parallel_scan, checkpoint_chunks)
 
 #helper class
-class NonlinearOptim3CellY(nn.Module):
+class NonlinearOptim3CellY(MLP2):
     def __init__(self, xNeural_size, yhat_size):
-        super(NonlinearOptim3CellY, self).__init__()
-        self.Cy2_lin = nn.Linear(xNeural_size, xNeural_size, dtype=torch.double)
-        self.Cy2_relu = nn.ReLU()
-        self.Cy2_lin2 = nn.Linear(xNeural_size, yhat_size, dtype=torch.double)
-        self.Cy2_sigmoid = nn.Sigmoid()
-    def forward(self, xNeural_t):
-        y_pred = self.Cy2_lin(xNeural_t)
-        y_pred = self.Cy2_relu(y_pred)
-        y_pred = self.Cy2_lin2(y_pred)
-        y_pred = self.Cy2_sigmoid(y_pred)
-        return y_pred
+        super(NonlinearOptim3CellY, self).__init__(xNeural_size, xNeural_size, yhat_size) #Cy2
     
 class Optim3(nn.Module):
-    def __init__(self,xBehavioral_size, xNeural_size, y_size, u_size, yhat_size, zhat_size):
+    def __init__(self,xBehavioral_size, xNeural_size, y_size, u_size, yhat_size, zhat_size, parallel_scan = False, checkpoint_chunks = 0, detach_behav_states = True):
         super(Optim3, self).__init__()
         self.xNeural_size = xNeural_size
+        self.detach_behav_states = detach_behav_states #False also backprops into Stage 1 through behavStates
+        self.parallel_scan = parallel_scan #O(log seq_len) depth scan instead of the sequential loop, useful for long sequences on GPU
+        self.checkpoint_chunks = checkpoint_chunks #>1 recomputes the parallel scan in this many chunks during backward to save activation memory
+        if checkpoint_chunks > 1 and not parallel_scan:
+            raise ValueError('checkpoint_chunks only applies to parallel_scan=True, the sequential loop keeps no activations to free')
         self.zhat_size = zhat_size
         self.rnn_cell = Optim3Cell(xBehavioral_size, xNeural_size, y_size, u_size)
         self.nonlinear_cellY = NonlinearOptim3CellY(xNeural_size, yhat_size)
+        self.register_buffer('x0', torch.zeros(1, xNeural_size), persistent=False) #initial neural state, follows the module on .to(device)
     def forward(self, behavStates, y, u):
         # Assuming y and u are of shape (batch_size, seq_len, feature_size)
         batch_size, seq_len, _ = y.size()
 
+        #Stage 2 trains on fixed Stage 1 states, cut the graph so backward never reaches the Optim1 time loop
+        if self.detach_behav_states:
+            behavStates = behavStates.detach()
+
         # Initialize neural state with zeros
-        xNeural_t = torch.zeros(batch_size, self.xNeural_size, dtype= torch.double).to(y.device)
-
-        #horizontally combine neural data (y) and behavioral latent states (behavStates)
-        yAndxBehav = torch.cat((y, behavStates), dim = 2)
-
-        # Iterate over the sequence
-        y_hats2 = [] #Cy2(xNeural)
-        xNeural_states = [] 
-
-        for t in range(seq_len):
-            xNeural_states.append(xNeural_t)
-            yAndxBehav_t = yAndxBehav[:,t,:]
-            u_t = u[:,t, :]
-            x_next = self.rnn_cell(xNeural_t, yAndxBehav_t, u_t) #forward pass into custom rnn cell
-            y_pred = self.nonlinear_cellY(xNeural_t) #forward pass from x_t+1 (nonlinear combination of x_t+1 -> y_t+1) included in backprop
-            y_hats2.append(y_pred)
-            xNeural_t = x_next #x_t+1 becomes x_t for next time step (t) in for loop
-        
-        # Stack the outputs to get a tensor of shape (batch_size, seq_len, output_size)
-        y_hats2 = torch.stack(y_hats2, dim=1)
-        xNeural_states = torch.stack(xNeural_states, dim=1)
+        xNeural_t = self.x0.expand(batch_size, -1)
+
+        #K*[y_t, xBehav_t] + B*u_t for all time steps, shape (batch_size, seq_len, xNeural_size)
+        precomp = self.rnn_cell.premul(y, behavStates, u)
+
+        # Iterate over the sequence, the cell runs the whole recurrence in the scripted loop (or scan)
+        xNeural_states = self.rnn_cell(xNeural_t, precomp, self.parallel_scan, self.checkpoint_chunks) #xNeural, shape (batch_size, seq_len, xNeural_size)
+        y_hats2 = self.nonlinear_cellY(xNeural_states) #Cy2(xNeural) over all time steps at once, included in backprop
 
         return y_hats2, xNeural_states
 
-class Optim4(nn.Module):
+class Optim4(MLP2):
     def __init__(self, xNeural_size, zhat_size):
-        super(Optim4, self).__init__()
-        self.Cz2_lin = nn.Linear(xNeural_size, xNeural_size, dtype=torch.double)
-        self.Cz2_relu = nn.ReLU()
-        self.Cz2_lin2 = nn.Linear(xNeural_size, zhat_size, dtype=torch.double)
-        self.Cz2_sigmoid = nn.Sigmoid()
-    def forward(self, xNeural_t):
-        # Assuming xBehav_t has shape (batch_size, seq_len, feature_size)
-        _, seq_len, _ = xNeural_t.size()
-
-        z_hats2 = [] #Cz2
-        for t in range(seq_len):
-            x_t = xNeural_t[:,t,:]
-            z_pred = self.Cz2_lin(x_t)
-            z_pred = self.Cz2_relu(z_pred)
-            z_pred = self.Cz2_lin2(z_pred)
-            z_pred = self.Cz2_sigmoid(z_pred)
-            z_hats2.append(z_pred)
-
-        z_hats2 = torch.stack(z_hats2, dim=1)
-        return z_hats2
+        super(Optim4, self).__init__(xNeural_size, xNeural_size, zhat_size) #Cz2
     
         
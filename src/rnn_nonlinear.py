@@ -8,9 +8,9 @@ class CustomRNNCell(nn.Module):
     def __init__(self, x_size, y_size, u_size):
         super(CustomRNNCell, self).__init__()
         self.xNext_size = x_size
-        self.W_A = nn.Linear(x_size, self.xNext_size, dtype=torch.double)
-        self.W_K = nn.Linear(y_size, self.xNext_size, dtype=torch.double)
-        self.W_B = nn.Linear(u_size, self.xNext_size, dtype=torch.double)
+        self.W_A = nn.Linear(x_size, self.xNext_size)
+        self.W_K = nn.Linear(y_size, self.xNext_size)
+        self.W_B = nn.Linear(u_size, self.xNext_size)
 
     def forward(self, x_t, y_t, u_t):
         xNext = self.W_A(x_t) + self.W_K(y_t) + self.W_B(u_t)
@@ -20,9 +20,9 @@ class CustomRNNCell(nn.Module):
 class NonlinearRNNCellY(nn.Module):
     def __init__(self, x_size, yhat_size):
         super(NonlinearRNNCellY, self).__init__()
-        self.Cy_lin = nn.Linear(x_size, x_size, dtype=torch.double)
+        self.Cy_lin = nn.Linear(x_size, x_size)
         self.Cy_relu = nn.ReLU()
-        self.Cy_lin2 = nn.Linear(x_size, yhat_size, dtype=torch.double)
+        self.Cy_lin2 = nn.Linear(x_size, yhat_size)
         self.Cy_sigmoid = nn.Sigmoid()
     def forward(self, x_t):
         yhat = self.Cy_lin(x_t)
@@ -35,9 +35,9 @@ class NonlinearRNNCellY(nn.Module):
 class NonlinearRNNCellZ(nn.Module):
     def __init__(self, x_size, zhat_size):
         super(NonlinearRNNCellZ, self).__init__()
-        self.Cz_lin = nn.Linear(x_size, x_size, dtype=torch.double)
+        self.Cz_lin = nn.Linear(x_size, x_size)
         self.Cz_relu = nn.ReLU()
-        self.Cz_lin2 = nn.Linear(x_size, zhat_size, dtype=torch.double)
+        self.Cz_lin2 = nn.Linear(x_size, zhat_size)
         self.Cz_sigmoid = nn.Sigmoid()
     def forward(self, x_t):
         zhat = self.Cz_lin(x_t)
@@ -59,7 +59,7 @@ class CustomRNN(nn.Module):
         batch_size, seq_len, _ = y.size()
 
         # Initialize the hidden state
-        x_t = torch.zeros(batch_size, self.x_size, dtype= torch.double).to(y.device)
+        x_t = torch.zeros(batch_size, self.x_size).to(y.device)
         
         # Iterate over the sequence
         y_hats = []
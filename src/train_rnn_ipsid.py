@@ -0,0 +1,228 @@
+import argparse
+import os
+#the RNN loops create many small tensors of varying sizes; expandable segments let the CUDA caching allocator grow one region
+#instead of leaving fragmented blocks between iterations. Must be set before torch initializes CUDA, an existing value wins
+#(if expandable segments are unsuitable, use e.g. PYTORCH_CUDA_ALLOC_CONF=max_split_size_mb:128 instead)
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data.distributed import DistributedSampler
+import proccessGordonStanley
+import rnn_ipsid_nonlinear as rnn_ipsid_nonLin
+
+# Trains the nonlinear RNN-IPSID (Stage 1 and Stage 2) the same way as gordon_jupyter.ipynb.
+# Single process:  python src/train_rnn_ipsid.py
+# Multiple GPUs:   torchrun --nproc_per_node=<num_gpus> src/train_rnn_ipsid.py
+# Under torchrun every GPU gets its own process and a shard of the sequences, and DistributedDataParallel
+# all-reduces the gradients during backward (no single-threaded master GPU as with DataParallel).
+
+###################################################################################################################################################################
+
+#helper fxn
+def setupDistributed():
+    #torchrun sets LOCAL_RANK, plain python runs as a single process
+    if 'LOCAL_RANK' not in os.environ:
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        return device, False
+    local_rank = int(os.environ['LOCAL_RANK'])
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group(backend='nccl')
+        device = torch.device('cuda', local_rank)
+    else:
+        dist.init_process_group(backend='gloo')
+        device = torch.device('cpu')
+    return device, True
+
+#helper fxn
+def isMainProcess():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+#helper fxn
+def makeLoader(tensors, batch_size, distributed):
+    #every rank sees a disjoint shard of the sequences; batch_size None means one full batch per epoch (as in the notebook)
+    dataset = TensorDataset(*tensors)
+    #drop_last leaves out the remainder sequences instead of repeating some of them to even out the shards
+    sampler = DistributedSampler(dataset, shuffle=False, drop_last=True) if distributed else None
+    if len(sampler if sampler is not None else dataset) == 0:
+        raise ValueError('no training sequences on this process, lower --sequence_length or the number of processes')
+    if batch_size is None:
+        batch_size = len(sampler) if sampler is not None else len(dataset)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, shuffle=False)
+
+#helper fxn
+def wrapModel(model, device, distributed):
+    model = model.to(device)
+    if distributed:
+        device_ids = [device.index] if device.type == 'cuda' else None
+        model = DistributedDataParallel(model, device_ids=device_ids, bucket_cap_mb=25)
+    return model
+
+#helper fxn
+def trainOptimizer(name, model, loader, computeLoss, num_epochs, lr, device, snapshot_path=None):
+    #generic loop for one optimizer: computeLoss(model, batch) returns the loss to backprop
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    train_losses = []
+    record_memory = snapshot_path is not None and device.type == 'cuda'
+    if record_memory and dist.is_initialized():
+        #one pickle per rank, otherwise the ranks overwrite each other's snapshot
+        root, ext = os.path.splitext(snapshot_path)
+        snapshot_path = f'{root}.rank{dist.get_rank()}{ext}'
+    if record_memory:
+        torch.cuda.memory._record_memory_history() #allocator history of the first epoch, open the dump at pytorch.org/memory_viz
+    for epoch in range(num_epochs):
+        if isinstance(loader.sampler, DistributedSampler):
+            loader.sampler.set_epoch(epoch)
+        for batch in loader:
+            batch = [tensor.to(device, non_blocking=True) for tensor in batch]
+            optimizer.zero_grad() #reset gradients
+            loss = computeLoss(model, batch) #forward pass
+            loss.backward() #backwards pass - DDP all-reduces the gradients here
+            optimizer.step() #updates the weights
+
+        if record_memory and epoch == 0:
+            torch.cuda.memory._dump_snapshot(snapshot_path)
+            torch.cuda.memory._record_memory_history(enabled=None)
+            if isMainProcess():
+                print(f'{name} allocator snapshot written to {snapshot_path}')
+
+        #average the last loss over ranks for logging only, gradients are already synchronized by DDP
+        logged_loss = loss.detach()
+        if dist.is_initialized():
+            dist.all_reduce(logged_loss)
+            logged_loss /= dist.get_world_size()
+        train_losses.append(logged_loss.item())
+        if isMainProcess():
+            print(f'{name} Epoch [{epoch+1}/{num_epochs}], Loss: {logged_loss.item():.8f}')
+    return train_losses
+
+#helper fxn
+@torch.no_grad()
+def predictAll(model, tensors, device):
+    #runs the unwrapped model on the full training set so later stages can reuse its outputs (probabilities, not logits)
+    model = model.module if isinstance(model, DistributedDataParallel) else model
+    model.eval()
+    predict = getattr(model, 'predict', model)
+    outputs = predict(*[tensor.to(device) for tensor in tensors])
+    model.train()
+    if isinstance(outputs, tuple):
+        return tuple(output.detach().cpu() for output in outputs)
+    return outputs.detach().cpu()
+
+#helper fxn
+@torch.no_grad()
+def testOptimizer(name, model, tensors, computeLoss, device):
+    #same loss as in training on the full test set, like the test cells of the notebook
+    model = model.module if isinstance(model, DistributedDataParallel) else model
+    model.eval()
+    loss = computeLoss(model, [tensor.to(device) for tensor in tensors])
+    model.train()
+    if isMainProcess():
+        print(f'{name} Test Loss: {loss.item():.8f}')
+    return loss.item()
+
+#helper fxn
+def saveModel(model, output_dir, filename):
+    #state dict of the unwrapped model, written once by the main process
+    if not isMainProcess():
+        return
+    model = model.module if isinstance(model, DistributedDataParallel) else model
+    torch.save(model.state_dict(), os.path.join(output_dir, filename))
+
+###################################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description='Train the nonlinear RNN-IPSID on the Gordon data')
+    parser.add_argument('--thetaco_filepath', default='theta_coherence_with_behavior.csv')
+    parser.add_argument('--raw_filepath', default='filtered_lfp.csv')
+    parser.add_argument('--sequence_length', type=int, default=30000)
+    parser.add_argument('--training_size', type=float, default=0.8)
+    parser.add_argument('--x_size', type=int, default=3)
+    parser.add_argument('--xNeural_size', type=int, default=5)
+    parser.add_argument('--yhat_size', type=int, default=None, help='default: same as the neural data (y_size)')
+    parser.add_argument('--zhat_size', type=int, default=1)
+    parser.add_argument('--num_epochs', type=int, default=30)
+    parser.add_argument('--lr', type=float, default=0.05)
+    parser.add_argument('--batch_size', type=int, default=None, help='sequences per step on each process (default: whole shard)')
+    parser.add_argument('--parallel_scan', action='store_true', help='run the RNN time loops as a parallel scan over time instead of the sequential loop')
+    parser.add_argument('--checkpoint_chunks', type=int, default=0, help='with --parallel_scan, recompute the scan in this many chunks during backward to save memory')
+    parser.add_argument('--memory_snapshot', default=None, help='write a CUDA allocator snapshot of the first Stage 1 epoch to this pickle file')
+    parser.add_argument('--tf32', action='store_true', help='use TF32 tensor cores for the float32 matmuls on Ampere+ GPUs (faster, less precise latent states over long sequences)')
+    parser.add_argument('--skip_stage2', action='store_true')
+    parser.add_argument('--output_dir', default='trained_models', help='directory for the state dicts of the trained models')
+    args = parser.parse_args()
+    if args.checkpoint_chunks > 1 and not args.parallel_scan:
+        parser.error('--checkpoint_chunks requires --parallel_scan, the sequential loop keeps no activations to free')
+
+    device, distributed = setupDistributed()
+
+    #TF32 keeps only a 10-bit mantissa: fine for the batched premul/readout matmuls, but the error of the addmm in the time loop
+    #compounds over seq_len steps of the latent states, so it is opt-in like float32 over bfloat16.
+    #No cuDNN flags are set, the model only runs matmuls and pointwise ops and never reaches cuDNN
+    if args.tf32:
+        torch.set_float32_matmul_precision('high')
+
+    dataProcessor = proccessGordonStanley.GordonStanleyDataProcessor(args.raw_filepath, args.thetaco_filepath, args.batch_size, args.sequence_length, True, args.training_size)
+    y_training, y_testing, target_y_training, target_y_testing, u_training, u_testing, _, _, target_z_training, target_z_testing = dataProcessor.processGordon()
+    y_size = y_training.shape[2]
+    u_size = u_training.shape[2]
+    if args.yhat_size is None:
+        args.yhat_size = y_size
+    #the binary behavior (Correct) of Stage 1 is fit with BCE on the Cz1 logits, the neural data and the
+    #stage sums are not probabilities and keep the MSE on the sigmoid readouts, as in the notebook
+    lossfxn = nn.MSELoss()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    #RNN-IPSID Stage 1, Part 1: learn A'(1), K(1), Cz(1) while minimizing behavior loss
+    stage1_optim1 = wrapModel(rnn_ipsid_nonLin.Optim1(args.x_size, y_size, u_size, args.yhat_size, args.zhat_size, parallel_scan=args.parallel_scan, checkpoint_chunks=args.checkpoint_chunks, z_logits=True), device, distributed)
+    loader = makeLoader((y_training, u_training, target_z_training), args.batch_size, distributed)
+    computeLoss = lambda model, batch: F.binary_cross_entropy_with_logits(model(batch[0], batch[1])[0], batch[2])
+    trainOptimizer('Stage 1 pt 1', stage1_optim1, loader, computeLoss, args.num_epochs, args.lr, device, args.memory_snapshot)
+    testOptimizer('Stage 1 pt 1', stage1_optim1, (y_testing, u_testing, target_z_testing), computeLoss, device)
+    saveModel(stage1_optim1, args.output_dir, 'stage1_optim1.pt')
+    z_hats_part1_training, xBehav_states_part1_training = predictAll(stage1_optim1, (y_training, u_training), device)
+    z_hats_part1_testing, xBehav_states_part1_testing = predictAll(stage1_optim1, (y_testing, u_testing), device)
+
+    #RNN-IPSID Stage 1, Part 2: learn Cy(1) from the extracted behavioral states while minimizing neural loss
+    stage1_optim2 = wrapModel(rnn_ipsid_nonLin.Optim2(args.x_size, args.yhat_size), device, distributed)
+    loader = makeLoader((xBehav_states_part1_training, target_y_training), args.batch_size, distributed)
+    computeLoss = lambda model, batch: lossfxn(model(batch[0]), batch[1])
+    trainOptimizer('Stage 1 pt 2', stage1_optim2, loader, computeLoss, args.num_epochs, args.lr, device)
+    testOptimizer('Stage 1 pt 2', stage1_optim2, (xBehav_states_part1_testing, target_y_testing), computeLoss, device)
+    saveModel(stage1_optim2, args.output_dir, 'stage1_optim2.pt')
+    y_hats_part1_training = predictAll(stage1_optim2, (xBehav_states_part1_training,), device)
+    y_hats_part1_testing = predictAll(stage1_optim2, (xBehav_states_part1_testing,), device)
+
+    if not args.skip_stage2:
+        #RNN-IPSID Stage 2, Part 1: learn A'(2), K(2), Cy(2) on the neural residual of Stage 1
+        stage2_optim3 = wrapModel(rnn_ipsid_nonLin.Optim3(args.x_size, args.xNeural_size, y_size, u_size, args.yhat_size, args.zhat_size, parallel_scan=args.parallel_scan, checkpoint_chunks=args.checkpoint_chunks), device, distributed)
+        loader = makeLoader((xBehav_states_part1_training, y_training, u_training, y_hats_part1_training, target_y_training), args.batch_size, distributed)
+        computeLoss = lambda model, batch: lossfxn(batch[3] + model(batch[0], batch[1], batch[2])[0], batch[4])
+        trainOptimizer('Stage 2 pt 1', stage2_optim3, loader, computeLoss, args.num_epochs, args.lr, device)
+        testOptimizer('Stage 2 pt 1', stage2_optim3, (xBehav_states_part1_testing, y_testing, u_testing, y_hats_part1_testing, target_y_testing), computeLoss, device)
+        saveModel(stage2_optim3, args.output_dir, 'stage2_optim3.pt')
+        _, xNeural_states_training = predictAll(stage2_optim3, (xBehav_states_part1_training, y_training, u_training), device)
+        _, xNeural_states_testing = predictAll(stage2_optim3, (xBehav_states_part1_testing, y_testing, u_testing), device)
+
+        #RNN-IPSID Stage 2, Part 2: learn Cz(2) from the neural states on the behavioral residual of Stage 1
+        stage2_optim4 = wrapModel(rnn_ipsid_nonLin.Optim4(args.xNeural_size, args.zhat_size), device, distributed)
+        loader = makeLoader((xNeural_states_training, z_hats_part1_training, target_z_training), args.batch_size, distributed)
+        computeLoss = lambda model, batch: lossfxn(batch[1] + model(batch[0]), batch[2])
+        trainOptimizer('Stage 2 pt 2', stage2_optim4, loader, computeLoss, args.num_epochs, args.lr, device)
+        testOptimizer('Stage 2 pt 2', stage2_optim4, (xNeural_states_testing, z_hats_part1_testing, target_z_testing), computeLoss, device)
+        saveModel(stage2_optim4, args.output_dir, 'stage2_optim4.pt')
+
+    if isMainProcess():
+        print(f'state dicts written to {args.output_dir}')
+
+    if distributed:
+        dist.destroy_process_group()
+
+if __name__ == '__main__':
+    main()